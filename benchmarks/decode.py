@@ -0,0 +1,77 @@
+"""
+Times decoding a page of large clusters, without touching redis or the
+database:
+
+    python benchmarks/decode.py [clusters] [items per cluster]
+"""
+import sys
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+
+settings.configure(INSTALLED_APPS=["timeline"])
+
+from django.utils import simplejson as json
+
+from timeline.base import (EventType, ContextItemType, Stream,
+    deserialize_context_items, status_key)
+
+class User(ContextItemType):
+    pass
+
+class Follow(EventType):
+    slug = "benchmark-follow"
+    context_shape = {
+        "follower": User,
+        "following": User,
+    }
+    queryable_by = ["follower", "following"]
+    default_cluster_by = "following"
+
+def make_page(clusters, items_per_cluster):
+    page = []
+    start = datetime(2010, 10, 8)
+    for i in xrange(clusters):
+        items = []
+        for j in xrange(items_per_cluster):
+            t = start + timedelta(seconds=j)
+            event = Follow({
+                "follower": "user%d" % j,
+                "following": "celebrity%d" % i,
+            }, t)
+            context = event.serialize_context(event.context)
+            items.append({
+                "id": i * items_per_cluster + j,
+                "context": context,
+                "remove": False,
+                "timestamp": tuple(t.timetuple())[:-3],
+                "status_key": status_key(context),
+            })
+        page.append((json.dumps({
+            "slug": Follow.slug,
+            "items": items,
+            "clustered_on": "following",
+            "cluster_id": i,
+        }), time.mktime(start.timetuple()) - i))
+    return page
+
+def main(clusters=20, items_per_cluster=500, repeat=5):
+    page = make_page(clusters, items_per_cluster)
+    stream = Stream()
+    best = None
+    for i in xrange(repeat):
+        t = time.time()
+        context_items = {}
+        parsed_items, statuses = stream._decode(page, context_items)
+        list(stream._build(
+            parsed_items, statuses, deserialize_context_items(context_items)
+        ))
+        elapsed = time.time() - t
+        best = elapsed if best is None else min(best, elapsed)
+    print "%d clusters x %d items: %.1fms" % (
+        clusters, items_per_cluster, best * 1000
+    )
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -11,7 +11,7 @@ setup(
     include_package_data=True,
     install_requires=[
         'django>=1.3.1',
-        'redis>=2.0.0'
+        'redis>=2.10.0'
     ],
     classifiers = [
         "Development Status :: 4 - Beta",
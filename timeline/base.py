@@ -1,12 +1,20 @@
 import hashlib
+import logging
+import multiprocessing
+import threading
 import time
 import uuid
-from collections import defaultdict, namedtuple
+import zlib
+from collections import defaultdict, namedtuple, OrderedDict
 from datetime import datetime, timedelta
+from itertools import chain, islice
+from operator import itemgetter
 
 import redis
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
 from django.db.models import Model
 from django.template import Context
 from django.template.loader import render_to_string
@@ -15,9 +23,130 @@ from django.utils import simplejson as json
 from .models import (StreamItem as StreamItemModel,
     StreamCluster as StreamClusterModel)
 
-# TODO: ...
-def get_redis_connection():
-    return redis.Redis(**settings.REDIS_SETTINGS)
+logger = logging.getLogger(__name__)
+
+_connection_pools = {}
+
+# Each socket timeout needs its own pool, so only these are used.
+SOCKET_TIMEOUTS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60]
+
+def get_redis_connection(socket_timeout=None):
+    """
+    Returns a client for ``REDIS_SETTINGS``, optionally with a different
+    ``socket_timeout`` (in seconds), rounded down to one of
+    ``SOCKET_TIMEOUTS``.  Clients share a connection pool, so this is cheap to
+    call.
+    """
+    options = dict(settings.REDIS_SETTINGS)
+    if socket_timeout is not None:
+        options["socket_timeout"] = max(
+            [t for t in SOCKET_TIMEOUTS if t <= socket_timeout] or
+            SOCKET_TIMEOUTS[:1]
+        )
+    key = tuple(sorted(options.iteritems()))
+    if key not in _connection_pools:
+        _connection_pools[key] = redis.Redis(**options).connection_pool
+    return redis.Redis(connection_pool=_connection_pools[key])
+
+ALL_EVENTS = "ALL_EVENTS"
+
+def all_events_keys():
+    """
+    The global stream is split across ``TIMELINE_ALL_EVENTS_SHARDS`` sorted
+    sets so writers don't all contend on (and scan) a single key.
+    """
+    shards = getattr(settings, "TIMELINE_ALL_EVENTS_SHARDS", 8)
+    return ["%s:%d" % (ALL_EVENTS, i) for i in xrange(shards)]
+
+def all_events_key(value):
+    """
+    The shard for an event is picked by hashing the value it's clustered on,
+    that way events which can cluster together always land in the same shard.
+    """
+    keys = all_events_keys()
+    return keys[(zlib.crc32(json.dumps(value)) & 0xffffffff) % len(keys)]
+
+def global_stream_keys():
+    """
+    The keys the global stream is read from: its shards, plus the single
+    ``ALL_EVENTS`` key older versions wrote to, until ``reshard_all_events``
+    has drained it.
+    """
+    return all_events_keys() + [ALL_EVENTS]
+
+def reshard_all_events(batch_size=100, pause=0):
+    """
+    Moves clusters which aren't in the shard they belong in, i.e. everything
+    in the old ``ALL_EVENTS`` key or in shards left over from a larger
+    ``TIMELINE_ALL_EVENTS_SHARDS``, into their shards.  Returns the number of
+    clusters moved.
+    """
+    redis = get_redis_connection()
+    current = set(all_events_keys())
+    sources = [ALL_EVENTS] + [
+        key for key in redis.scan_iter("%s:*" % ALL_EVENTS, count=batch_size)
+        if key not in current
+    ]
+    moved = 0
+    for source in sources:
+        while True:
+            items = redis.zrange(source, 0, batch_size - 1, withscores=True)
+            if not items:
+                break
+            targets = set()
+            pipe = redis.pipeline()
+            for item, score in items:
+                data = json.loads(item)
+                value = data["items"][0]["context"][data["clustered_on"]]
+                target = all_events_key(value)
+                targets.add(target)
+                pipe.zadd(target, item, score)
+                pipe.zrem(source, item)
+            pipe.execute()
+            bump_versions(redis, targets | set([source]))
+            moved += len(items)
+            time.sleep(pause)
+    return moved
+
+def get_channel(key):
+    """
+    The pub/sub channel notified when an event is added to the stream stored
+    at ``key``.  The global stream is notified on ``ALL_EVENTS``.
+    """
+    return "timeline:%s" % key
+
+def get_version_key(key):
+    return "timeline:version:%s" % key
+
+def bump_versions(redis, keys):
+    """
+    Invalidates any cached pages of the streams stored at ``keys``, see
+    ``PageCache``.
+    """
+    if getattr(settings, "TIMELINE_PAGE_CACHE", False):
+        pipe = redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.incr(get_version_key(key))
+        pipe.execute()
+
+def merge_ranges(results, start, stop):
+    """
+    Given the results of ``zrevrange(key, 0, stop)`` for several keys, returns
+    what ``zrevrange(key, start, stop)`` over their union would, without
+    having to build the union.
+    """
+    items = sorted(chain(*results), key=itemgetter(1), reverse=True)
+    return items[start:stop + 1]
+
+SchemaField = namedtuple("SchemaField", ["spec", "unique_key"])
+EventSchema = namedtuple("EventSchema", ["slug", "fields"])
+
+def status_key(context):
+    """
+    Identifies an event by its serialized context, which is how a remove is
+    paired up with the add it cancels out.
+    """
+    return json.dumps(sorted(context.iteritems()))
 
 class EventTypeMetaclass(type):
     def __new__(cls, name, bases, attrs):
@@ -25,15 +154,17 @@ class EventTypeMetaclass(type):
         if hasattr(new_cls, "context_shape"):
             for k, v in new_cls.context_shape.iteritems():
                 if issubclass(v, Model):
-                    class Klass(ModelContextItemType):
-                        model = v
-                    new_cls.context_shape[k] = Klass
+                    new_cls.context_shape[k] = model_context_item_type(v)
         if hasattr(new_cls, "slug"):
             new_cls.registry[new_cls.slug] = new_cls
             assert new_cls.slug is not None
             assert new_cls.context_shape is not None
             assert new_cls.queryable_by is not None
             assert new_cls.default_cluster_by is not None
+            new_cls.schema = EventSchema(new_cls.slug, dict(
+                (k, SchemaField(v, v.unique_key()))
+                for k, v in new_cls.context_shape.iteritems()
+            ))
 
         return new_cls
 
@@ -43,6 +174,15 @@ class EventType(object):
     registry = {}
 
     cluster = True
+    # Events are added to a cluster that started less than ``cluster_window``
+    # before them, until it has ``max_cluster_items`` events in it.
+    cluster_window = timedelta(minutes=5)
+    max_cluster_items = None
+
+    # Retention rules: how long events of this type are kept for (a
+    # timedelta), and how many of them are kept in each stream.  See ``sweep``.
+    max_age = None
+    max_count = None
 
     def __init__(self, context, timestamp=None, remove=False):
         if timestamp is None:
@@ -68,7 +208,46 @@ class EventType(object):
             self._redis = get_redis_connection()
         return self._redis
 
+    @classmethod
+    def from_record(cls, record):
+        """
+        Rebuilds an event from a record produced by ``to_record``.
+
+        The record only holds the serialized context, so every context item
+        type's ``valid_obj`` and ``serialize`` have to accept what its
+        ``serialize`` returns, as ``ContextItemType`` and
+        ``ModelContextItemType`` do.  Event types with context items that
+        don't can't be saved with ``TIMELINE_ASYNC``.
+        """
+        event_type = cls.registry[record["slug"]]
+        return event_type(
+            record["context"],
+            datetime.fromtimestamp(record["timestamp"]),
+            record["remove"],
+        )
+
+    def to_record(self):
+        t = self.timestamp
+        return {
+            "token": uuid.uuid4().hex,
+            "slug": self.slug,
+            "context": self.serialize_context(self.context),
+            "remove": self.remove,
+            "timestamp": time.mktime(t.timetuple()) + 1e-6 * t.microsecond,
+        }
+
     def save(self):
+        """
+        Writes the event to the database and to each of the streams it belongs
+        in.  If ``TIMELINE_ASYNC`` is set the event is only put on the queue,
+        and the ``timeline_worker`` command does the writing.
+        """
+        if getattr(settings, "TIMELINE_ASYNC", False):
+            self.redis.lpush(get_queue_key(), json.dumps(self.to_record()))
+        else:
+            self._save()
+
+    def _save(self):
         context = self.serialize_context(self.context)
         s = StreamItemModel.objects.create(
             context = json.dumps(context),
@@ -80,48 +259,502 @@ class EventType(object):
 
         record = {
             "id": s.pk,
-            "context": self.serialize_context(self.context),
+            "context": context,
             "remove": self.remove,
             "timestamp": tuple(t.timetuple())[:-3],
+            "status_key": status_key(context),
         }
+        writes = []
         for field in self.queryable_by:
             obj_key = self.context_shape[field](self.context[field]).lookup_key()
-            keys = [obj_key, "%s:%s" % (obj_key, self.slug)]
+            writes.append((field, [obj_key, "%s:%s" % (obj_key, self.slug)]))
+        cluster_spec = self.context_shape[self.default_cluster_by]
+        all_events = all_events_key(
+            cluster_spec.serialize(self.context[self.default_cluster_by])
+        )
+
+        # Read the clusters the event could join, for every key, up front.
+        pipe = self.redis.pipeline(transaction=False)
+        for field, keys in writes:
+            for key in keys:
+                pipe.zrevrange(key, 0, 5, withscores=True)
+        pipe.zrevrange(all_events, 0, 5, withscores=True)
+        candidates = iter(pipe.execute())
+        written = set()
+
+        scores = []
+        for field, keys in writes:
             c = None
             for key in keys:
-                c = self._add_to_key(field, key, timestamp, record, c, s)
-        self._add_to_key(
-            self.default_cluster_by, "ALL_EVENTS", timestamp, record, c, s
+                c, score = self._add_to_key(field, key, timestamp, record, c,
+                    s, self._candidates(key, candidates, written))
+                scores.append((key, score))
+        c, score = self._add_to_key(
+            self.default_cluster_by, all_events, timestamp, record, c, s,
+            self._candidates(all_events, candidates, written)
         )
+        scores.append((ALL_EVENTS, score))
+        max_length = getattr(settings, "TIMELINE_ALL_EVENTS_MAX_LENGTH", None)
+        if max_length is not None:
+            pipe = self.redis.pipeline()
+            pipe.zrange(all_events, 0, -max_length - 1)
+            pipe.zremrangebyrank(all_events, 0, -max_length - 1)
+            trimmed = pipe.execute()[0]
+            if trimmed:
+                # Leave their rows for ``sweep`` to delete.
+                self.redis.rpush(get_trimmed_key(), *trimmed)
+
+        bump_versions(self.redis, written)
+
+        if getattr(settings, "TIMELINE_PUBLISH", False):
+            pipe = self.redis.pipeline(transaction=False)
+            for key, score in scores:
+                pipe.publish(get_channel(key), json.dumps({
+                    "key": key,
+                    "score": score,
+                    "slug": self.slug,
+                    "id": s.pk,
+                }))
+            pipe.execute()
 
-    def _add_to_key(self, field, key, timestamp, record, c, s):
-        for item, score in self.redis.zrevrange(key, 0, 5, withscores=True):
+    def _candidates(self, key, candidates, written):
+        items = candidates.next()
+        if key in written:
+            # This event has already been added to the key (an event can
+            # reference the same object twice), so what was read is stale.
+            items = self.redis.zrevrange(key, 0, 5, withscores=True)
+        written.add(key)
+        return items
+
+    def _add_to_key(self, field, key, timestamp, record, c, s, candidates):
+        for item, score in candidates:
             cluster_timestamp = datetime.fromtimestamp(score)
             data = json.loads(item)
             if (data["slug"] == self.slug and self.cluster and
                 data["items"][0]["context"][data["clustered_on"]] == self.context_shape[field].serialize(self.context[field]) and
-                self.timestamp - cluster_timestamp < timedelta(minutes=5)):
+                self.timestamp - cluster_timestamp < self.cluster_window):
+                if (self.max_cluster_items is not None and
+                    len(data["items"]) >= self.max_cluster_items):
+                    # The cluster is full, so it's sealed and a new one is
+                    # started, which mustn't share the full one's row.
+                    if c is not None and c.pk == data["cluster_id"]:
+                        c = None
+                    break
                 c = StreamClusterModel.objects.get(pk=data["cluster_id"])
                 c.items.add(s)
                 data["items"].append(record)
-                self.redis.zrem(key, item)
-                self.redis.zadd(key, json.dumps(data), score)
-                break
-        else:
-            if c is None:
-                c = StreamClusterModel.objects.create(
-                    event_type = self.slug,
-                    clustered_on = field,
-                )
-                c.items.add(s)
-            data = json.dumps({
-                "slug": self.slug,
-                "items": [record],
-                "clustered_on": field,
-                "cluster_id": c.pk,
-            })
-            self.redis.zadd(key, data, timestamp)
-        return c
+                pipe = self.redis.pipeline()
+                pipe.zrem(key, item)
+                pipe.zadd(key, json.dumps(data), score)
+                pipe.execute()
+                return c, score
+        if c is None:
+            c = StreamClusterModel.objects.create(
+                event_type = self.slug,
+                clustered_on = field,
+            )
+            c.items.add(s)
+        data = json.dumps({
+            "slug": self.slug,
+            "items": [record],
+            "clustered_on": field,
+            "cluster_id": c.pk,
+        })
+        self.redis.zadd(key, data, timestamp)
+        return c, timestamp
+
+def get_trimmed_key():
+    return "timeline:trimmed"
+
+def get_queue_key():
+    return getattr(settings, "TIMELINE_QUEUE_KEY", "timeline:queue")
+
+def process_queue(batch_size=100, timeout=0):
+    """
+    Saves up to ``batch_size`` queued events, returning how many were handled.
+    If ``timeout`` is given, waits that many seconds for the first event.
+
+    Records are moved to a processing list while they're being saved and only
+    dropped from it afterwards, so a crashed worker loses nothing (see
+    ``recover_queue``).  Every saved record's token is remembered for a day as
+    soon as it's saved, which makes replaying a record a no-op, even if the
+    worker died partway through the batch.
+
+    Each event's rows are committed as they're written, before the redis
+    writes which point at them, since those can't be rolled back.  A record
+    that can't be saved is logged and moved to the ``<queue>:dead`` list.
+    """
+    redis = get_redis_connection()
+    queue_key = get_queue_key()
+    processing_key = "%s:processing" % queue_key
+
+    records = []
+    if timeout:
+        record = redis.brpoplpush(queue_key, processing_key, timeout)
+        if record is None:
+            return 0
+        records.append(record)
+    pipe = redis.pipeline(transaction=False)
+    for i in xrange(batch_size - len(records)):
+        pipe.rpoplpush(queue_key, processing_key)
+    records.extend(r for r in pipe.execute() if r is not None)
+    if not records:
+        return 0
+
+    decoded = [json.loads(record) for record in records]
+    pipe = redis.pipeline(transaction=False)
+    for data in decoded:
+        pipe.exists("%s:done:%s" % (queue_key, data["token"]))
+    done = pipe.execute()
+
+    saved = set()
+    pipe = redis.pipeline(transaction=False)
+    for record, data, already_done in zip(records, decoded, done):
+        if not already_done and data["token"] not in saved:
+            try:
+                EventType.from_record(data)._save()
+            except Exception:
+                transaction.rollback_unless_managed()
+                logger.exception("Couldn't save queued event %s", record)
+                pipe.lpush("%s:dead" % queue_key, record)
+                pipe.lrem(processing_key, record, 1)
+                continue
+            redis.setex("%s:done:%s" % (queue_key, data["token"]), 1,
+                60 * 60 * 24)
+            saved.add(data["token"])
+        pipe.lrem(processing_key, record, 1)
+    pipe.execute()
+    return len(records)
+
+def recover_queue():
+    """
+    Puts any records left in the processing list by a crashed worker back on
+    the queue.  Only call this when no workers are running.
+    """
+    redis = get_redis_connection()
+    queue_key = get_queue_key()
+    processing_key = "%s:processing" % queue_key
+    count = 0
+    while redis.rpoplpush(processing_key, queue_key) is not None:
+        count += 1
+    return count
+
+def decode_cluster(item):
+    """
+    Decodes a member of a stream, or returns ``None`` if it isn't a cluster,
+    e.g. because the sorted set it came from isn't a stream at all.
+    """
+    try:
+        data = json.loads(item)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or "slug" not in data or "items" not in data:
+        return None
+    return data
+
+def expired_clusters(redis, key, now, batch_size=100, max_count=True):
+    """
+    Returns ``(member, score, data, keep)`` for each cluster in ``key`` which
+    has outlived the ``max_age`` or (unless ``max_count`` is ``False``) the
+    ``max_count`` of its event type.  ``keep`` is how many of its newest events
+    are still within ``max_count``, 0 if the whole cluster has to go.
+    """
+    registry = EventType.registry
+    max_ages = [t.max_age for t in registry.itervalues() if t.max_age is not None]
+    if max_count and any(t.max_count is not None for t in registry.itervalues()):
+        # Counting needs to walk the whole key, newest first.
+        read = lambda start: redis.zrevrange(
+            key, start, start + batch_size - 1, withscores=True
+        )
+    elif max_ages:
+        cutoff = time.mktime((now - min(max_ages)).timetuple())
+        read = lambda start: redis.zrangebyscore(
+            key, "-inf", cutoff, start=start, num=batch_size, withscores=True
+        )
+    else:
+        return []
+
+    counts = defaultdict(int)
+    expired = []
+    start = 0
+    while True:
+        items = read(start)
+        for item, score in items:
+            data = decode_cluster(item)
+            if data is None:
+                continue
+            event_type = registry.get(data["slug"])
+            if event_type is None:
+                continue
+            if (event_type.max_age is not None and
+                    datetime.fromtimestamp(score) < now - event_type.max_age):
+                expired.append((item, score, data, 0))
+                continue
+            if not max_count or event_type.max_count is None:
+                continue
+            keep = max(event_type.max_count - counts[data["slug"]], 0)
+            counts[data["slug"]] += len(data["items"])
+            if keep < len(data["items"]):
+                expired.append((item, score, data, keep))
+        if len(items) < batch_size:
+            return expired
+        start += batch_size
+
+def stream_keys(event_type, record):
+    """
+    The keys of every stream the event in ``record`` (as stored in a cluster)
+    is added to.
+    """
+    context = record["context"]
+    keys = [ALL_EVENTS, all_events_key(context[event_type.default_cluster_by])]
+    for field in event_type.queryable_by:
+        obj_key = event_type.context_shape[field](context[field]).lookup_key()
+        keys.extend([obj_key, "%s:%s" % (obj_key, event_type.slug)])
+    return keys
+
+def removed_events(redis, records):
+    """
+    Returns the ids of the events in ``records`` (``(event_type, record)``
+    pairs) which aren't in any stream anymore.
+    """
+    pipe = redis.pipeline(transaction=False)
+    counts = []
+    for event_type, record in records:
+        window = event_type.cluster_window.total_seconds()
+        timestamp = time.mktime(datetime(*record["timestamp"]).timetuple())
+        keys = stream_keys(event_type, record)
+        for key in keys:
+            # The cluster holding it started at most a cluster window before
+            # it, and the record's timestamp drops the microseconds.
+            pipe.zrangebyscore(key, timestamp - window, timestamp + 1)
+        counts.append(len(keys))
+    results = iter(pipe.execute())
+    removed = []
+    for (event_type, record), count in zip(records, counts):
+        found = any(
+            o["id"] == record["id"]
+            for items in islice(results, count)
+            for item in items
+            for o in json.loads(item)["items"]
+        )
+        if not found:
+            removed.append(record["id"])
+    return removed
+
+def sweep(batch_size=100, pause=0):
+    """
+    Removes every cluster that's past its event type's retention rules from
+    redis, ``batch_size`` keys, members or rows at a time with a ``pause`` (in
+    seconds) between batches.  A cluster which straddles ``max_count`` loses
+    its oldest events.  The global stream only applies ``max_age`` (and
+    ``TIMELINE_ALL_EVENTS_MAX_LENGTH``, on write).
+
+    The rows for an event are deleted once it isn't in any stream.  Returns
+    the number of clusters removed or trimmed and of events deleted.
+    """
+    redis = get_redis_connection()
+    now = datetime.now()
+    all_events = set(global_stream_keys())
+    registry = EventType.registry
+    clusters_removed = 0
+    records = {}
+
+    def collect(data, items):
+        event_type = registry.get(data["slug"])
+        if event_type is not None:
+            for o in items:
+                records[o["id"]] = (event_type, o)
+
+    keys = redis.scan_iter(count=batch_size)
+    while True:
+        batch = list(islice(keys, batch_size))
+        if not batch:
+            break
+        pipe = redis.pipeline(transaction=False)
+        for key in batch:
+            pipe.type(key)
+        for key, key_type in zip(batch, pipe.execute()):
+            if key_type != "zset":
+                continue
+            expired = expired_clusters(
+                redis, key, now, batch_size, max_count=key not in all_events
+            )
+            for i in xrange(0, len(expired), batch_size):
+                pipe = redis.pipeline()
+                for item, score, data, keep in expired[i:i + batch_size]:
+                    pipe.zrem(key, item)
+                    if keep:
+                        collect(data, data["items"][:-keep])
+                        data["items"] = data["items"][-keep:]
+                        pipe.zadd(key, json.dumps(data), score)
+                    else:
+                        collect(data, data["items"])
+                pipe.execute()
+                time.sleep(pause)
+            if expired:
+                bump_versions(redis, [key])
+            clusters_removed += len(expired)
+        time.sleep(pause)
+
+    # Clusters trimmed from the global stream on write, they're only dropped
+    # from the list once their rows are gone.
+    trimmed_key = get_trimmed_key()
+    trimmed = 0
+    while True:
+        items = redis.lrange(trimmed_key, trimmed, trimmed + batch_size - 1)
+        if not items:
+            break
+        for item in items:
+            data = decode_cluster(item)
+            if data is not None:
+                collect(data, data["items"])
+        trimmed += len(items)
+
+    item_ids = []
+    records = records.values()
+    for i in xrange(0, len(records), batch_size):
+        item_ids.extend(removed_events(redis, records[i:i + batch_size]))
+        time.sleep(pause)
+    for i in xrange(0, len(item_ids), batch_size):
+        StreamItemModel.objects.filter(pk__in=item_ids[i:i + batch_size]).delete()
+        time.sleep(pause)
+    while True:
+        cluster_ids = list(StreamClusterModel.objects.filter(
+            items__isnull=True
+        ).values_list("pk", flat=True)[:batch_size])
+        if not cluster_ids:
+            break
+        StreamClusterModel.objects.filter(pk__in=cluster_ids).delete()
+        time.sleep(pause)
+    redis.ltrim(trimmed_key, trimmed, -1)
+    return clusters_removed, len(item_ids)
+
+def get_backfill_key(event_type, fields):
+    return "timeline:backfill:%s:%s" % (event_type.slug, ",".join(sorted(fields)))
+
+def backfill_shard(event_type, shard, fields, chunk_size=500, pause=0):
+    """
+    Adds the events of ``event_type`` in the global stream shard ``shard`` to
+    the streams for its ``fields`` that don't have them yet, e.g. after those
+    were added to ``queryable_by``.  Events are left out of streams which
+    already hold the ``max_count`` newer events of their type.
+
+    The shard is read ``chunk_size`` clusters at a time, sleeping ``pause``
+    seconds in between, and the score reached is saved after each chunk so an
+    interrupted backfill carries on where it stopped, even if older clusters
+    have been trimmed or swept since.  It's cleared once the shard is done.
+    Returns the number of events added to at least one stream.
+    """
+    redis = get_redis_connection()
+    checkpoint_key = get_backfill_key(event_type, fields)
+    window = event_type.cluster_window
+    window = window.days * 60 * 60 * 24 + window.seconds
+    # The last score handled, and the clusters with that score which were.
+    checkpoint = redis.hget(checkpoint_key, shard)
+    min_score, done = json.loads(checkpoint) if checkpoint else ("-inf", [])
+    added = 0
+    while True:
+        clusters = [
+            (item, score)
+            for item, score in redis.zrangebyscore(shard, min_score, "+inf",
+                start=0, num=chunk_size + len(done), withscores=True)
+            if score != min_score or item not in done
+        ]
+        if not clusters:
+            redis.hdel(checkpoint_key, shard)
+            return added
+        records = [
+            o
+            for data in (json.loads(item) for item, score in clusters)
+            if data["slug"] == event_type.slug
+            for o in data["items"]
+        ]
+        # Events which have been swept from the database are skipped.
+        rows = StreamItemModel.objects.in_bulk([o["id"] for o in records])
+
+        # A cluster holding the event would have started at most a cluster
+        # window before it, read those from every stream in one round trip.
+        writes = []
+        pipe = redis.pipeline(transaction=False)
+        for o in records:
+            if o["id"] not in rows:
+                continue
+            event = event_type(o["context"], datetime(*o["timestamp"]), o["remove"])
+            # Records drop the microseconds, so the event may be up to a second
+            # later than its timestamp (and so the cluster it started).
+            timestamp = time.mktime(event.timestamp.timetuple())
+            for field in fields:
+                obj_key = event.context_shape[field](event.context[field]).lookup_key()
+                keys = [obj_key, "%s:%s" % (obj_key, event.slug)]
+                for key in keys:
+                    pipe.zrevrangebyscore(key, timestamp + 1, timestamp - window,
+                        withscores=True)
+                    if event_type.max_count is not None:
+                        pipe.zrevrangebyscore(key, "+inf", timestamp + 1,
+                            start=0, num=event_type.max_count)
+                writes.append((event, o, rows[o["id"]], timestamp, field, keys))
+        candidates = iter(pipe.execute())
+
+        written = set()
+        added_ids = set()
+        for event, o, row, timestamp, field, keys in writes:
+            c = None
+            for key in keys:
+                items = candidates.next()
+                if event_type.max_count is not None:
+                    newer = sum(
+                        len(data["items"])
+                        for data in map(json.loads, candidates.next())
+                        if data["slug"] == event_type.slug
+                    )
+                    if newer >= event_type.max_count:
+                        continue
+                if key in written:
+                    items = redis.zrevrangebyscore(key, timestamp + 1,
+                        timestamp - window, withscores=True)
+                if any(other["id"] == o["id"]
+                    for item, score in items
+                    for other in json.loads(item)["items"]):
+                    continue
+                c, score = event._add_to_key(field, key, timestamp, o, c, row,
+                    items)
+                written.add(key)
+                added_ids.add(o["id"])
+        bump_versions(redis, written)
+        added += len(added_ids)
+
+        last = clusters[-1][1]
+        if last != min_score:
+            min_score, done = last, []
+        done.extend(item for item, score in clusters if score == last)
+        redis.hset(checkpoint_key, shard, json.dumps([min_score, done]))
+        time.sleep(pause)
+
+def _backfill_shard(args):
+    slug, shard, fields, chunk_size, pause = args
+    return backfill_shard(
+        EventType.registry[slug], shard, fields, chunk_size, pause
+    )
+
+def backfill(event_type, fields, processes=1, chunk_size=500, pause=0):
+    """
+    Runs ``backfill_shard`` over every shard of the global stream, spread over
+    ``processes`` processes.  Returns the number of events added.
+    """
+    args = [
+        (event_type.slug, shard, fields, chunk_size, pause)
+        for shard in global_stream_keys()
+    ]
+    if processes <= 1:
+        return sum(map(_backfill_shard, args))
+    # The children can't share the database connection.
+    connection.close()
+    pool = multiprocessing.Pool(processes)
+    try:
+        return sum(pool.map(_backfill_shard, args))
+    finally:
+        pool.close()
+        pool.join()
 
 class ContextItemType(object):
     def __init__(self, obj):
@@ -154,18 +787,63 @@ class ContextItemType(object):
         )
 
 class ModelContextItemType(ContextItemType):
+    """
+    A context item that's a model instance.  Subclasses can control how the
+    instances are loaded when a stream is displayed:
+
+    - ``only``: the fields to load, everything else is deferred.
+    - ``select_related`` / ``prefetch_related``: relations to load along with
+      the objects (``prefetch_related`` requires Django 1.4).
+    - ``manager``: the name of the manager to use, instead of the default one.
+    - ``using``: the database alias to read from, e.g. a read replica.
+    """
     model = None
+    only = None
+    select_related = None
+    prefetch_related = None
+    manager = None
+    using = None
 
     def lookup_key(self):
         return "%s:%s:%s" % (
             self.model._meta.app_label,
             self.model._meta.object_name,
-            self.obj.pk
+            self.serialize(self.obj)
         )
 
     @classmethod
     def unique_key(cls):
-        return cls.model
+        plan = cls.loading_plan()
+        if not any(plan):
+            return cls.model
+        # Fields with different plans can't share a query.
+        return (cls.model,) + plan
+
+    @classmethod
+    def loading_plan(cls):
+        return (
+            tuple(cls.only or ()),
+            tuple(cls.select_related or ()),
+            tuple(cls.prefetch_related or ()),
+            cls.manager,
+            cls.using,
+        )
+
+    @classmethod
+    def get_query_set(cls):
+        if cls.manager is not None:
+            qs = getattr(cls.model, cls.manager).all()
+        else:
+            qs = cls.model._default_manager.all()
+        if cls.using is not None:
+            qs = qs.using(cls.using)
+        if cls.only:
+            qs = qs.only(*cls.only)
+        if cls.select_related:
+            qs = qs.select_related(*cls.select_related)
+        if cls.prefetch_related:
+            qs = qs.prefetch_related(*cls.prefetch_related)
+        return qs
 
     @classmethod
     def valid_obj(cls, obj):
@@ -173,15 +851,31 @@ class ModelContextItemType(ContextItemType):
 
     @classmethod
     def serialize(cls, obj):
+        if isinstance(obj, (int, long)):
+            return obj
         return obj.pk
 
     @classmethod
     def deserialize(cls, obj):
-        return cls.model._default_manager.get(pk=obj)
+        return cls.get_query_set().get(pk=obj)
 
     @classmethod
     def deserialize_bulk(cls, objs):
-        return cls.model._default_manager.in_bulk(objs)
+        return cls.get_query_set().in_bulk(objs)
+
+_model_context_item_types = {}
+
+def model_context_item_type(model):
+    """
+    Returns the ``ModelContextItemType`` for ``model``, creating it the first
+    time it's asked for.
+    """
+    if model not in _model_context_item_types:
+        class Klass(ModelContextItemType):
+            pass
+        Klass.model = model
+        _model_context_item_types[model] = Klass
+    return _model_context_item_types[model]
 
 class StreamItem(object):
     def __init__(self, slug, timestamp, context, item_id, cluster_id):
@@ -240,23 +934,136 @@ class StreamCluster(object):
             context.pop()
 
 RawResults = namedtuple("RawResults", ["field", "vals"])
-Status = namedtuple("Status", ["adds", "removes"])
+
+class Placeholder(object):
+    """
+    Stands in for a context item that wasn't loaded in time, see the
+    ``budget_ms`` argument to ``Stream``.  It's false, so templates can check
+    for it with ``{% if event.user %}``.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __nonzero__(self):
+        return False
+
+    def __unicode__(self):
+        return u""
+
+class Placeholders(dict):
+    def __missing__(self, value):
+        return Placeholder(value)
+
+def deserialize_context_items(context_items, deadline=None):
+    """
+    Loads the collected context items, one ``deserialize_bulk`` per field.
+    Once ``deadline`` (a ``time.time()``) has passed, the remaining fields get
+    ``Placeholder`` objects instead.
+    """
+    final_context_items = {}
+    for key, (field, vals) in context_items.iteritems():
+        if deadline is not None and time.time() >= deadline:
+            final_context_items[key] = Placeholders()
+        else:
+            final_context_items[key] = field.deserialize_bulk(vals)
+    return final_context_items
+
+class PageCache(object):
+    """
+    Keeps the decoded clusters on pages of streams, in a bounded LRU in this
+    process backed by Django's cache.  A page is cached under the current
+    version of each key it's read from, and ``EventType.save`` bumps the
+    versions of the keys it writes, so stale pages are never returned.  Pages
+    are kept for ``timeout`` seconds in both.
+    """
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def keys(self, redis, streams):
+        """
+        Returns the current cache key for the page of each of ``streams``,
+        fetching the versions they depend on in a single round trip.
+        """
+        source_keys = [stream._source_keys() for stream in streams]
+        version_keys = [get_version_key(key) for key in chain(*source_keys)]
+        versions = iter(redis.mget(version_keys))
+        result = []
+        for stream, keys in zip(streams, source_keys):
+            s = hashlib.sha1()
+            s.update(repr((
+                [(key, versions.next()) for key in keys],
+                stream.offset, stream.limit, stream.since, stream.dedup,
+                stream.prefer,
+            )))
+            result.append("timeline:page:%s" % s.hexdigest())
+        return result
+
+    def get_many(self, keys):
+        found = {}
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                if key in self.pages:
+                    expires, page = self.pages.pop(key)
+                    if expires > now:
+                        found[key] = page
+                        self.pages[key] = expires, page
+        missing = [key for key in keys if key not in found]
+        if missing:
+            shared = cache.get_many(missing)
+            self._remember(shared)
+            found.update(shared)
+        return found
+
+    def set_many(self, pages):
+        self._remember(pages)
+        cache.set_many(pages, self.timeout)
+
+    def _remember(self, pages):
+        expires = time.time() + self.timeout
+        with self.lock:
+            for key, page in pages.iteritems():
+                self.pages.pop(key, None)
+                self.pages[key] = expires, page
+            while len(self.pages) > self.size:
+                self.pages.popitem(last=False)
+
+_page_cache = None
+
+def get_page_cache():
+    global _page_cache
+    if _page_cache is None:
+        _page_cache = PageCache(
+            getattr(settings, "TIMELINE_PAGE_CACHE_SIZE", 1000),
+            getattr(settings, "TIMELINE_PAGE_CACHE_TIMEOUT", 60 * 5),
+        )
+    return _page_cache
 
 class Stream(object):
     def __init__(self, *objs, **kwargs):
         event_type = kwargs.pop("event_type", None)
         limit = kwargs.pop("limit", 20)
         offset = kwargs.pop("offset", 0)
+        since = kwargs.pop("since", None)
+        dedup = kwargs.pop("dedup", None)
+        prefer = kwargs.pop("prefer", "first")
+        cache = kwargs.pop("cache", None)
+        budget_ms = kwargs.pop("budget_ms", None)
 
         if kwargs:
             raise TypeError("Unexpected keyword argument: %s" % kwargs)
+        if dedup not in (None, "item", "cluster"):
+            raise ValueError("dedup must be None, 'item' or 'cluster'")
+        if prefer not in ("first", "newest"):
+            raise ValueError("prefer must be 'first' or 'newest'")
 
         final_objs = []
         for obj in objs:
             if isinstance(obj, Model):
-                class Klass(ModelContextItemType):
-                    model = type(obj)
-                final_objs.append(Klass(obj))
+                final_objs.append(model_context_item_type(type(obj))(obj))
             else:
                 final_objs.append(obj)
 
@@ -264,64 +1071,295 @@ class Stream(object):
         self.event_type = event_type
         self.limit = limit
         self.offset = offset
+        self.since = since
+        self.dedup = dedup
+        self.prefer = prefer
+        # Writes only invalidate cached pages when the setting is on, so
+        # ``cache`` can only turn the cache off.
+        self.cache = (cache is not False and
+            getattr(settings, "TIMELINE_PAGE_CACHE", False))
+        self.budget_ms = budget_ms
+        # What was skipped to stay within ``budget_ms``, set when the stream
+        # is read.
+        self.degradations = []
 
-    def __iter__(self):
-        redis = get_redis_connection()
-
+    def _lookup_keys(self):
         postfix = ""
         if self.event_type is not None:
             postfix += ":%s" % (self.event_type.slug)
-        lookup_keys = [
+        return [
             obj.lookup_key() + postfix
             for obj in self.objs
         ]
 
+    def _source_keys(self):
+        return self._lookup_keys() or global_stream_keys()
+
+    def _read(self, pipe):
+        """
+        Queues the reads for this stream's page on the pipeline ``pipe``.
+        Returns the number of commands queued, and a function which turns
+        their results into the page's ``(cluster, score)`` pairs.
+        """
+        lookup_keys = self._lookup_keys()
+        if not lookup_keys:
+            assert not self.event_type
+            keys = global_stream_keys()
+            for key in keys:
+                self._range(pipe, key, 0, self.limit)
+            return len(keys), lambda results: merge_ranges(
+                results, self.offset, self.limit
+            )
+        if len(lookup_keys) >= 2 and self.dedup is not None:
+            return self._read_deduped(pipe, lookup_keys)
+        max_keys = getattr(settings, "TIMELINE_MAX_UNION_KEYS", 10)
+        if self.budget_ms is not None and len(lookup_keys) > max_keys:
+            # Building the union is linear in the size of every key, instead
+            # merge the newest clusters of each key.
+            self.degradations.append("union_skipped")
+            for key in lookup_keys:
+                self._range(pipe, key, 0, self.limit)
+            return len(lookup_keys), lambda results: merge_ranges(
+                results, self.offset, self.limit
+            )
         if len(lookup_keys) >= 2:
             s = hashlib.sha1()
             for lookup_key in lookup_keys:
                 s.update(lookup_key)
             key = s.hexdigest()
-            redis.zunionstore(key, lookup_keys, aggregate="MIN")
+            pipe.zunionstore(key, lookup_keys, aggregate="MIN")
             # Expire it in 5 minutes, enough that paginating shouldn't require
             # a recompute, but short enough to not clutter the place up.
-            redis.expire(key, 60 * 5)
-        elif len(lookup_keys) == 1:
-            key = lookup_keys[0]
+            pipe.expire(key, 60 * 5)
+            self._range(pipe, key, self.offset, self.limit)
+            return 3, itemgetter(-1)
+        self._range(pipe, lookup_keys[0], self.offset, self.limit)
+        return 1, itemgetter(0)
+
+    def _range(self, pipe, key, start, stop):
+        if self.since is None:
+            pipe.zrevrange(key, start, stop, withscores=True)
         else:
-            assert not self.event_type
-            key = "ALL_EVENTS"
+            pipe.zrevrangebyscore(key, "+inf", self.since, start=start,
+                num=max(stop - start + 1, 0), withscores=True)
+
+    def _read_deduped(self, pipe, lookup_keys):
+        # Read the same number of clusters from each key, and read further
+        # ahead until there are enough left after removing the duplicates.
+        for key in lookup_keys:
+            self._range(pipe, key, 0, self.limit)
+
+        def finish(results):
+            results = map(list, results)
+            fetched = self.limit + 1
+            while True:
+                page, complete = self._dedup(results, fetched)
+                if complete:
+                    return page
+                for key in lookup_keys:
+                    self._range(pipe, key, fetched, fetched * 2 - 1)
+                for items, more in zip(results, pipe.execute()):
+                    items.extend(more)
+                fetched *= 2
+        return len(lookup_keys), finish
+
+    def _dedup(self, results, fetched):
+        """
+        Merges the clusters read from each lookup key (``results``, in the
+        order the objects were given), keeping each cluster or item only once.
+        Returns the page, and whether enough was read for it to be complete.
+        """
+        candidates = []
+        for priority, items in enumerate(results):
+            for item, score in items:
+                candidates.append((score, priority, json.loads(item)))
+        if self.prefer == "first":
+            rank = lambda candidate: (candidate[1], -candidate[0])
+        else:
+            rank = lambda candidate: (-candidate[0], candidate[1])
+
+        winners = {}
+        for candidate in sorted(candidates, key=rank):
+            data = candidate[2]
+            if self.dedup == "cluster":
+                winners.setdefault(data["cluster_id"], candidate)
+            else:
+                for o in data["items"]:
+                    winners.setdefault(o["id"], candidate)
+
+        page = []
+        priorities = []
+        for score, priority, data in sorted(candidates, key=lambda c: (-c[0], c[1])):
+            if self.dedup == "cluster":
+                if winners[data["cluster_id"]][2] is not data:
+                    continue
+            else:
+                data["items"] = [
+                    o for o in data["items"] if winners[o["id"]][2] is data
+                ]
+                if not data["items"]:
+                    continue
+            page.append((data, score))
+            priorities.append(priority)
+
+        # Clusters scored below what's been read from a key that has more in
+        # it might still lose out to (or be displaced by) unread duplicates.
+        # When the first key wins, so might a duplicate in an earlier key
+        # scored up to a cluster window lower, since a cluster's score is
+        # when it started.
+        unfinished = [
+            (priority, items[-1][1]) for priority, items in enumerate(results)
+            if len(items) == fetched
+        ]
+        if unfinished:
+            frontier = max(last for priority, last in unfinished)
+            window = self._cluster_window()
+            settled = 0
+            for (data, score), priority in zip(page, priorities):
+                if score <= frontier:
+                    break
+                if self.prefer == "first" and any(
+                    p < priority and last >= score - window
+                    for p, last in unfinished
+                ):
+                    break
+                settled += 1
+            if settled <= self.limit:
+                return None, False
+        return page[self.offset:self.limit + 1], True
+
+    def _cluster_window(self):
+        """
+        The longest ``cluster_window`` (in seconds) of the event types that
+        could be in this stream.
+        """
+        if self.event_type is not None:
+            event_types = [self.event_type]
+        else:
+            event_types = EventType.registry.values()
+        windows = [
+            t.cluster_window for t in event_types if t.cluster
+        ] or [timedelta(0)]
+        return max(windows).total_seconds()
+
+    def __iter__(self):
+        return iter(self.fetch_many([self])[0])
+
+    @staticmethod
+    def fetch_many(streams):
+        """
+        Fetches the current page of each of ``streams``, returning a list with
+        the clusters for each one.  All of the streams are read in a single
+        round trip to redis, and their context items are loaded together.
+        """
+        budgets = [
+            stream.budget_ms for stream in streams if stream.budget_ms is not None
+        ]
+        timeout = deadline = None
+        if budgets:
+            timeout = min(budgets) / 1000.0
+            deadline = time.time() + timeout
+        for stream in streams:
+            stream.degradations = []
+
+        try:
+            pages = Stream._read_many(streams, get_redis_connection(timeout))
+        except (redis.ConnectionError, redis.TimeoutError):
+            if deadline is None:
+                raise
+            pages = [[] for stream in streams]
+            for stream in streams:
+                stream.degradations.append("redis_unavailable")
 
-        statuses = defaultdict(lambda: Status(0, 0))
-        items = list(redis.zrevrange(key, self.offset, self.limit, withscores=True))
-        parsed_items = []
         context_items = {}
+        decoded = [
+            stream._decode(items, context_items)
+            for stream, items in zip(streams, pages)
+        ]
+        context_items = deserialize_context_items(context_items, deadline)
+        if any(isinstance(v, Placeholders) for v in context_items.itervalues()):
+            for stream, items in zip(streams, pages):
+                if items:
+                    stream.degradations.append("placeholders")
+        return [
+            list(stream._build(parsed_items, statuses, context_items))
+            for stream, (parsed_items, statuses) in zip(streams, decoded)
+        ]
+
+    @staticmethod
+    def _read_many(streams, redis):
+        cached = [stream for stream in streams if stream.cache]
+        cache_keys = {}
+        pages = {}
+        if cached:
+            cache_keys = dict(zip(cached, get_page_cache().keys(redis, cached)))
+            pages = get_page_cache().get_many(cache_keys.values())
+
+        pipe = redis.pipeline(transaction=False)
+        reads = [
+            None if cache_keys.get(stream) in pages else stream._read(pipe)
+            for stream in streams
+        ]
+        results = pipe.execute()
+
+        result = []
+        new_pages = {}
+        start = 0
+        for stream, read in zip(streams, reads):
+            if read is None:
+                items = pages[cache_keys[stream]]
+            else:
+                count, finish = read
+                items = finish(results[start:start + count])
+                start += count
+                if stream in cache_keys:
+                    items = [
+                        (cluster if isinstance(cluster, dict) else json.loads(cluster), score)
+                        for cluster, score in items
+                    ]
+                    new_pages[cache_keys[stream]] = items
+            result.append(items)
+        if new_pages:
+            get_page_cache().set_many(new_pages)
+        return result
+
+    def _decode(self, items, context_items):
+        """
+        Parses the raw ``(cluster, score)`` pairs read from redis, tallying the
+        adds and removes of each event and collecting the context values that
+        need deserializing into ``context_items``.
+        """
+        registry = EventType.registry
+        statuses = defaultdict(lambda: [0, 0])
+        parsed_items = []
         for cluster, score in items:
-            data = json.loads(cluster)
-            parsed_items.append((data, score))
+            if isinstance(cluster, dict):
+                # Already decoded, see ``_dedup``.
+                data = cluster
+            else:
+                data = json.loads(cluster)
+            slug = data["slug"]
+            fields = registry[slug].schema.fields
+            parsed_items.append((data, score, fields))
             for o in data["items"]:
-                status_key = self._status_key(data["slug"], o)
-                status = statuses[status_key]
-                if o["remove"]:
-                    statuses[status_key] = status._replace(removes=status.removes+1)
-                else:
-                    statuses[status_key] = status._replace(adds=status.adds+1)
-                for key, val in o["context"].iteritems():
-                    field = EventType.registry[data["slug"]].context_shape[key]
-                    key = field.unique_key()
-                    if key not in context_items:
-                        context_items[key] = RawResults(field, set())
-                    context_items[key].vals.add(val)
-
-        final_context_items = {}
-        for key, (field, vals) in context_items.iteritems():
-            final_context_items[key] = field.deserialize_bulk(vals)
+                context = o["context"]
+                if "status_key" not in o:
+                    o["status_key"] = status_key(context)
+                statuses[slug, o["status_key"]][o["remove"]] += 1
+                for key, val in context.iteritems():
+                    field = fields[key]
+                    if field.unique_key not in context_items:
+                        context_items[field.unique_key] = RawResults(field.spec, set())
+                    context_items[field.unique_key].vals.add(val)
+        return parsed_items, statuses
 
-        for data, score in parsed_items:
+    def _build(self, parsed_items, statuses, context_items):
+        for data, score, fields in parsed_items:
             cluster_items = []
             timestamp = datetime.fromtimestamp(score)
             for o in data["items"]:
                 item = self._convert_item(
-                    data["slug"], o, timestamp, statuses, final_context_items, data["cluster_id"]
+                    data["slug"], fields, o, statuses, context_items, data["cluster_id"]
                 )
                 if item is not None:
                     cluster_items.append(item)
@@ -337,25 +1375,19 @@ class Stream(object):
                     data["cluster_id"]
                 )
 
-    def _convert_item(self, slug, data, timestamp, statuses, context_items,
+    def _convert_item(self, slug, fields, data, statuses, context_items,
         cluster_id):
-        status_key = self._status_key(slug, data)
-        status = statuses[status_key]
-        if data["remove"]:
-            current_attr, other_attr = "removes", "adds"
-        else:
-            current_attr, other_attr = "adds", "removes"
-
-        if getattr(status, current_attr) <= getattr(status, other_attr):
+        # An add is only shown if it outnumbers the removes still to come for
+        # the same event, and vice versa.
+        status = statuses[slug, data["status_key"]]
+        remove = data["remove"]
+        if status[remove] <= status[not remove]:
             return
-        statuses[status_key] = status._replace(**{
-            current_attr: getattr(status, current_attr) - 1
-        })
+        status[remove] -= 1
 
         context = {}
         for key, value in data["context"].iteritems():
-            field = EventType.registry[slug].context_shape[key]
-            context[key] = context_items[field.unique_key()][value]
+            context[key] = context_items[fields[key].unique_key][value]
 
         return StreamItem(
             slug,
@@ -365,8 +1397,63 @@ class Stream(object):
             cluster_id,
         )
 
-    def _status_key(self, slug, data):
-        return (
-            slug,
-            tuple(sorted(data["context"].items()))
+class StreamListener(object):
+    """
+    Waits for events to be added to a stream, which requires the
+    ``TIMELINE_PUBLISH`` setting::
+
+        listener = StreamListener(Stream(user))
+        while True:
+            for cluster in listener.changes(timeout=30):
+                ...
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        keys = stream._lookup_keys() or [ALL_EVENTS]
+        self.pubsub = get_redis_connection().pubsub()
+        self.pubsub.subscribe([get_channel(key) for key in keys])
+
+    def wait(self, timeout=None):
+        """
+        Blocks until events are added to the stream, or for at most
+        ``timeout`` seconds.  Returns the notifications received: dicts with
+        the ``key`` written to, the ``score`` of the cluster the event is in,
+        and the ``slug`` and ``id`` of the event.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        notifications = []
+        while True:
+            if notifications:
+                wait = 0
+            elif deadline is None:
+                wait = 60
+            else:
+                wait = max(deadline - time.time(), 0)
+            message = self.pubsub.get_message(True, wait)
+            if message is not None:
+                notifications.append(json.loads(message["data"]))
+            elif notifications or (deadline is not None and time.time() >= deadline):
+                return notifications
+
+    def changes(self, timeout=None):
+        """
+        Like ``wait``, but returns the clusters the new events were added to,
+        at most ``limit`` of them, newest first.
+        """
+        notifications = self.wait(timeout)
+        if not notifications:
+            return []
+        stream = Stream(
+            *self.stream.objs,
+            event_type=self.stream.event_type,
+            limit=self.stream.limit,
+            since=min(n["score"] for n in notifications),
+            dedup=self.stream.dedup,
+            prefer=self.stream.prefer
         )
+        return list(stream)
+
+    def close(self):
+        self.pubsub.close()
@@ -0,0 +1,52 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from timeline.base import EventType, backfill, get_backfill_key, get_redis_connection
+
+class Command(BaseCommand):
+    args = "<slug>"
+    help = ("Adds existing events of an event type to the streams they "
+        "belong in, e.g. after changing its queryable_by.")
+    option_list = BaseCommand.option_list + (
+        make_option("--fields", dest="fields", default=None,
+            help="Comma separated fields to backfill, the ones added to the "
+            "event type's queryable_by."),
+        make_option("--processes", type="int", dest="processes", default=1,
+            help="How many processes to work in."),
+        make_option("--chunk-size", type="int", dest="chunk_size", default=500,
+            help="How many clusters to read at a time."),
+        make_option("--pause", type="float", dest="pause", default=0,
+            help="Seconds to sleep between chunks."),
+        make_option("--reset", action="store_true", dest="reset", default=False,
+            help="Start from the beginning instead of where the last run "
+            "stopped."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Expected a single event type slug.")
+        try:
+            event_type = EventType.registry[args[0]]
+        except KeyError:
+            raise CommandError("Unknown event type: %s" % args[0])
+        if not options["fields"]:
+            raise CommandError("--fields is required.")
+        fields = options["fields"].split(",")
+        for field in fields:
+            if field not in event_type.queryable_by:
+                raise CommandError("%s isn't in the queryable_by of %s" % (
+                    field, event_type.slug
+                ))
+
+        if options["reset"]:
+            get_redis_connection().delete(get_backfill_key(event_type, fields))
+        count = backfill(
+            event_type,
+            fields,
+            options["processes"],
+            options["chunk_size"],
+            options["pause"],
+        )
+        if int(options["verbosity"]):
+            self.stdout.write("Added %d events.\n" % count)
@@ -0,0 +1,20 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from timeline.base import reshard_all_events
+
+class Command(BaseCommand):
+    help = ("Moves the events in the global stream which aren't in their shard, "
+        "e.g. those saved before it was sharded, into their shard.")
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int", dest="batch_size", default=100,
+            help="How many clusters to move at a time."),
+        make_option("--pause", type="float", dest="pause", default=0.01,
+            help="Seconds to sleep between batches."),
+    )
+
+    def handle(self, **options):
+        moved = reshard_all_events(options["batch_size"], options["pause"])
+        if int(options["verbosity"]):
+            self.stdout.write("Moved %d clusters.\n" % moved)
@@ -0,0 +1,200 @@
+import re
+import time
+from collections import defaultdict
+from itertools import islice
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.utils import simplejson as json
+
+from timeline.base import decode_cluster, get_redis_connection
+
+# Stream(a, b) stores its union under the sha1 of the lookup keys.
+UNION_KEY_RE = re.compile(r"^[0-9a-f]{40}$")
+
+CLUSTER_SIZES = [(1, "1"), (5, "2-5"), (20, "6-20"), (100, "21-100"),
+    (None, "101+")]
+
+def cluster_size_bucket(n):
+    for limit, label in CLUSTER_SIZES:
+        if limit is None or n <= limit:
+            return label
+
+def collect_stats(redis, batch_size=100, sample=20, top=10, pause=0):
+    """
+    Walks every key in the database with ``SCAN``, sampling the first
+    ``sample`` clusters of each stream.  Sizes are in bytes; memory per event
+    type is estimated from the samples.  Sorted sets whose members aren't
+    clusters are counted under ``other_zsets``.
+    """
+    stats = {
+        "key_types": defaultdict(int),
+        "streams": 0,
+        "union_keys": 0,
+        "other_zsets": 0,
+        "clusters": 0,
+        "memory": 0,
+        "encodings": defaultdict(int),
+        "non_compact": 0,
+        "non_compact_keys": [],
+        "cluster_sizes": defaultdict(int),
+        "slugs": defaultdict(lambda: {
+            "sampled_clusters": 0,
+            "sampled_events": 0,
+            "sampled_bytes": 0,
+            "estimated_memory": 0,
+        }),
+        "largest": [],
+        "growth_per_day": 0,
+    }
+    keys = redis.scan_iter(count=batch_size)
+    while True:
+        batch = list(islice(keys, batch_size))
+        if not batch:
+            break
+        pipe = redis.pipeline(transaction=False)
+        for key in batch:
+            pipe.type(key)
+        zsets = []
+        for key, key_type in zip(batch, pipe.execute()):
+            stats["key_types"][key_type] += 1
+            if key_type == "zset":
+                zsets.append(key)
+
+        pipe = redis.pipeline(transaction=False)
+        for key in zsets:
+            pipe.zcard(key)
+            pipe.object("encoding", key)
+            pipe.execute_command("MEMORY USAGE", key)
+            pipe.zrevrange(key, 0, sample - 1, withscores=True)
+            pipe.zrange(key, 0, 0, withscores=True)
+        results = pipe.execute(raise_on_error=False)
+        for i, key in enumerate(zsets):
+            count, encoding, memory, members, oldest = results[i * 5:i * 5 + 5]
+            if isinstance(memory, Exception):
+                # MEMORY USAGE needs redis 4.0, fall back on the sample.
+                memory = None
+            if UNION_KEY_RE.match(key):
+                stats["union_keys"] += 1
+                continue
+            decoded = [decode_cluster(member) for member, score in members]
+            if None in decoded:
+                stats["other_zsets"] += 1
+                continue
+            stats["streams"] += 1
+            stats["clusters"] += count
+            stats["encodings"][encoding] += 1
+            if encoding == "skiplist":
+                stats["non_compact"] += 1
+                if len(stats["non_compact_keys"]) < top:
+                    stats["non_compact_keys"].append(key)
+
+            slug_bytes = defaultdict(int)
+            sampled_bytes = 0
+            for (member, score), data in zip(members, decoded):
+                slug = stats["slugs"][data["slug"]]
+                slug["sampled_clusters"] += 1
+                slug["sampled_events"] += len(data["items"])
+                slug["sampled_bytes"] += len(member)
+                slug_bytes[data["slug"]] += len(member)
+                sampled_bytes += len(member)
+                stats["cluster_sizes"][cluster_size_bucket(len(data["items"]))] += 1
+            if memory is None and members:
+                memory = sampled_bytes * count / len(members)
+            memory = memory or 0
+            stats["memory"] += memory
+            for slug, n in slug_bytes.iteritems():
+                stats["slugs"][slug]["estimated_memory"] += memory * n / sampled_bytes
+            stats["largest"] = sorted(
+                stats["largest"] + [(memory, count, key)], reverse=True
+            )[:top]
+
+            if members and oldest:
+                days = (members[0][1] - oldest[0][1]) / (60 * 60 * 24)
+                if days > 0:
+                    stats["growth_per_day"] += memory / days
+        time.sleep(pause)
+
+    stats["largest"] = [
+        {"key": key, "memory": memory, "clusters": count}
+        for memory, count, key in stats["largest"]
+    ]
+    stats["growth_per_day"] = int(stats["growth_per_day"])
+    return json.loads(json.dumps(stats))
+
+class Command(BaseCommand):
+    help = ("Reports how much memory timeline's streams use in redis, by key "
+        "and by event type.")
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int", dest="batch_size", default=100,
+            help="How many keys to look at per round trip."),
+        make_option("--sample", type="int", dest="sample", default=20,
+            help="How many of the newest clusters to sample in each stream."),
+        make_option("--top", type="int", dest="top", default=10,
+            help="How many of the largest streams to list."),
+        make_option("--pause", type="float", dest="pause", default=0,
+            help="Seconds to sleep between batches of keys."),
+        make_option("--json", action="store_true", dest="json", default=False,
+            help="Output JSON instead of a report."),
+    )
+
+    def handle(self, **options):
+        stats = collect_stats(
+            get_redis_connection(),
+            options["batch_size"],
+            options["sample"],
+            options["top"],
+            options["pause"],
+        )
+        if options["json"]:
+            self.stdout.write(json.dumps(stats, indent=4) + "\n")
+            return
+
+        write = lambda line="": self.stdout.write(line + "\n")
+        write("Streams: %d (%d clusters, %s)" % (
+            stats["streams"], stats["clusters"], format_bytes(stats["memory"])
+        ))
+        write("Union keys: %d" % stats["union_keys"])
+        other = dict(stats["key_types"], zset=stats["other_zsets"])
+        write("Other keys: %s" % ", ".join(
+            "%d %s" % (n, key_type)
+            for key_type, n in sorted(other.iteritems()) if n
+        ))
+        write("Encodings: %s" % ", ".join(
+            "%d %s" % (n, encoding)
+            for encoding, n in sorted(stats["encodings"].iteritems())
+        ))
+        write("Projected growth: %s/day" % format_bytes(stats["growth_per_day"]))
+        write()
+        write("Event types (from sampled clusters):")
+        for slug, s in sorted(stats["slugs"].iteritems()):
+            write("  %s: ~%s, %.1f events/cluster, %d bytes/cluster" % (
+                slug,
+                format_bytes(s["estimated_memory"]),
+                float(s["sampled_events"]) / s["sampled_clusters"],
+                s["sampled_bytes"] / s["sampled_clusters"],
+            ))
+        write()
+        write("Events per cluster (sampled):")
+        for limit, label in CLUSTER_SIZES:
+            write("  %s: %d" % (label, stats["cluster_sizes"].get(label, 0)))
+        write()
+        write("Largest streams:")
+        for s in stats["largest"]:
+            write("  %s: %s, %d clusters" % (
+                s["key"], format_bytes(s["memory"]), s["clusters"]
+            ))
+        if stats["non_compact"]:
+            write()
+            write("Streams not in a compact encoding: %d" % stats["non_compact"])
+            for key in stats["non_compact_keys"]:
+                write("  %s" % key)
+
+def format_bytes(n):
+    if n < 1024:
+        return "%dB" % n
+    for unit in ["KB", "MB"]:
+        n /= 1024.0
+        if n < 1024:
+            return "%.1f%s" % (n, unit)
+    return "%.1fGB" % (n / 1024.0)
@@ -0,0 +1,30 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from timeline.base import sweep
+
+class Command(BaseCommand):
+    help = ("Removes events which are past the max_age or max_count of their "
+        "event type.")
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int", dest="batch_size", default=100,
+            help="How many keys, clusters or rows to handle at a time."),
+        make_option("--pause", type="float", dest="pause", default=0.01,
+            help="Seconds to sleep between batches."),
+        make_option("--loop", action="store_true", dest="loop", default=False,
+            help="Keep sweeping instead of exiting after one pass."),
+        make_option("--interval", type="float", dest="interval", default=60,
+            help="Seconds to wait between passes when looping."),
+    )
+
+    def handle(self, **options):
+        while True:
+            clusters, items = sweep(options["batch_size"], options["pause"])
+            if int(options["verbosity"]):
+                self.stdout.write("Removed or trimmed %d clusters and deleted "
+                    "%d events.\n" % (clusters, items))
+            if not options["loop"]:
+                return
+            time.sleep(options["interval"])
@@ -0,0 +1,46 @@
+import threading
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from timeline.base import process_queue, recover_queue
+
+class Command(BaseCommand):
+    help = "Saves events queued by EventType.save when TIMELINE_ASYNC is set."
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int", dest="batch_size", default=100,
+            help="How many events to take off the queue at a time."),
+        make_option("--threads", type="int", dest="threads", default=1,
+            help="How many threads to drain the queue with."),
+        make_option("--once", action="store_true", dest="once", default=False,
+            help="Exit once the queue is empty instead of waiting for more."),
+        make_option("--recover", action="store_true", dest="recover",
+            default=False, help="Requeue events left behind by a crashed "
+            "worker before starting.  Don't use this while other workers "
+            "are running."),
+    )
+
+    def handle(self, **options):
+        if options["recover"]:
+            count = recover_queue()
+            if int(options["verbosity"]):
+                self.stdout.write("Requeued %d events.\n" % count)
+
+        threads = [
+            threading.Thread(target=self.work, args=(options,))
+            for i in xrange(options["threads"])
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        # Join with a timeout so the main thread still sees KeyboardInterrupt.
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(1)
+
+    def work(self, options):
+        timeout = 0 if options["once"] else 5
+        while True:
+            count = process_queue(options["batch_size"], timeout)
+            if not count and options["once"]:
+                return
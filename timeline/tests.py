@@ -1,13 +1,22 @@
+import time
 from contextlib import contextmanager
+from StringIO import StringIO
 from datetime import datetime, timedelta
 
 from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
 from django.contrib.auth.models import User as UserModel
 from django.db import connection, connections, DEFAULT_DB_ALIAS
 from django.template import TemplateDoesNotExist
 from django.test import TestCase
+from django.utils import simplejson as json
 
-from .base import get_redis_connection, EventType, ContextItemType, Stream, StreamCluster
+from .base import (get_redis_connection, ModelContextItemType, all_events_key, all_events_keys,
+    ALL_EVENTS, get_queue_key, process_queue, recover_queue, sweep, model_context_item_type,
+    get_page_cache, PageCache, deserialize_context_items, RawResults,
+    Placeholder, backfill, get_backfill_key,
+    EventType, ContextItemType, Stream, StreamCluster, StreamListener)
 from .models import StreamItem, StreamCluster as StreamClusterModel
 
 class EventTestCase(TestCase):
@@ -64,6 +73,19 @@ class AnotherEvent(EventType):
     queryable_by = ["user"]
     default_cluster_by = "user"
 
+class LightUser(ModelContextItemType):
+    model = UserModel
+    only = ["username"]
+    using = DEFAULT_DB_ALIAS
+
+class LightEvent(EventType):
+    slug = "light-event"
+    context_shape = {
+        "user": LightUser
+    }
+    queryable_by = ["user"]
+    default_cluster_by = "user"
+
 class Review(EventType):
     slug = "review"
     context_shape = {
@@ -73,6 +95,45 @@ class Review(EventType):
     cluster = False
     default_cluster_by = "reviewer"
 
+class Comment(EventType):
+    slug = "comment"
+    context_shape = {
+        "commenter": User,
+    }
+    queryable_by = ["commenter"]
+    cluster = False
+    default_cluster_by = "commenter"
+    max_count = 2
+
+class Like(EventType):
+    slug = "like"
+    context_shape = {
+        "liker": User,
+    }
+    queryable_by = ["liker"]
+    default_cluster_by = "liker"
+    max_age = timedelta(days=30)
+
+class Vote(EventType):
+    slug = "vote"
+    context_shape = {
+        "voter": User,
+        "candidate": User,
+    }
+    queryable_by = ["voter", "candidate"]
+    default_cluster_by = "candidate"
+    cluster_window = timedelta(minutes=1)
+    max_cluster_items = 2
+
+class Tag(EventType):
+    slug = "tag"
+    context_shape = {
+        "tagger": User,
+        "tagged": User,
+    }
+    queryable_by = ["tagger"]
+    default_cluster_by = "tagger"
+
 _missing = object()
 
 class EventTests(EventTestCase):
@@ -117,6 +178,14 @@ class EventTests(EventTestCase):
                 "follower": 2
             }, timestamp=datetime(2010, 10, 8))
 
+    def test_schema(self):
+        self.assertEqual(Follow.schema.slug, "follow")
+        self.assertEqual(Follow.schema.fields["follower"].unique_key, User)
+        field = SomeEvent.schema.fields["user"]
+        self.assertTrue(field.spec is model_context_item_type(UserModel))
+        self.assertTrue(field.spec is AnotherEvent.context_shape["user"])
+        self.assertEqual(field.unique_key, UserModel)
+
     def test_event_save(self):
         event = Follow({
             "follower": "alex",
@@ -134,6 +203,109 @@ class EventTests(EventTestCase):
             StreamClusterModel.objects.get(clustered_on="follower").pk
         )
 
+    def test_async_save(self):
+        settings.TIMELINE_ASYNC = True
+        try:
+            Follow({
+                "follower": "alex",
+                "following": "einstein",
+            }, timestamp=datetime(2010, 10, 8)).save()
+        finally:
+            del settings.TIMELINE_ASYNC
+
+        self.assertEqual(StreamItem.objects.count(), 0)
+        self.assertEqual(list(Stream(User("alex"))), [])
+
+        self.assertEqual(process_queue(), 1)
+        self.assertEqual(process_queue(), 0)
+        self.assertEqual(StreamItem.objects.count(), 1)
+        self.assert_stream_equal(Stream(User("alex")), [
+            StreamCluster("follow", datetime(2010, 10, 8), [
+                Follow({
+                    "follower": "alex",
+                    "following": "einstein",
+                }, datetime(2010, 10, 8)),
+            ])
+        ])
+
+    def test_async_save_replay(self):
+        u = UserModel.objects.create_user("joe", "joe@schmoe.net", "abc123")
+        record = SomeEvent({"user": u}, datetime(2010, 10, 8)).to_record()
+        redis = get_redis_connection()
+        redis.lpush(get_queue_key(), json.dumps(record))
+        process_queue()
+        # A worker died after saving the event but before acknowledging it.
+        redis.lpush("%s:processing" % get_queue_key(), json.dumps(record))
+        self.assertEqual(recover_queue(), 1)
+        process_queue()
+
+        self.assertEqual(StreamItem.objects.count(), 1)
+        self.assertEqual(len(list(Stream(u))), 1)
+
+    def test_async_save_replay_mid_batch(self):
+        redis = get_redis_connection()
+        for following in ["einstein", "bohr"]:
+            redis.lpush(get_queue_key(), json.dumps(Follow({
+                "follower": "alex",
+                "following": following,
+            }, datetime(2010, 10, 8)).to_record()))
+
+        calls = []
+        def _save(self):
+            calls.append(self)
+            if len(calls) == 2:
+                raise SystemExit
+            EventType._save(self)
+        Follow._save = _save
+        try:
+            # The worker dies while saving the second event.
+            self.assertRaises(SystemExit, process_queue)
+        finally:
+            del Follow._save
+        self.assertEqual(recover_queue(), 2)
+        process_queue()
+
+        self.assertEqual(StreamItem.objects.count(), 2)
+        self.assertEqual(len(list(Stream(User("alex")))), 1)
+
+    def test_async_save_dead_letter(self):
+        good = Follow({
+            "follower": "alex",
+            "following": "einstein",
+        }, datetime(2010, 10, 8)).to_record()
+        bad = dict(good, token="bad", slug="unknown")
+        redis = get_redis_connection()
+        redis.lpush(get_queue_key(), json.dumps(bad), json.dumps(good))
+
+        self.assertEqual(process_queue(), 2)
+        self.assertEqual(redis.llen("%s:processing" % get_queue_key()), 0)
+        self.assertEqual(
+            redis.lrange("%s:dead" % get_queue_key(), 0, -1), [json.dumps(bad)]
+        )
+        self.assertEqual(StreamItem.objects.count(), 1)
+        self.assertEqual(len(list(Stream(User("alex")))), 1)
+
+    def test_connection_pool_shared(self):
+        self.assertTrue(
+            get_redis_connection().connection_pool is
+            get_redis_connection().connection_pool
+        )
+        # Timeouts share a pool with the others close to them.
+        self.assertTrue(
+            get_redis_connection(0.123).connection_pool is
+            get_redis_connection(0.15).connection_pool
+        )
+
+    def test_event_save_same_object_twice(self):
+        Follow({
+            "follower": "alex",
+            "following": "alex",
+        }, timestamp=datetime(2010, 10, 8)).save()
+
+        redis = get_redis_connection()
+        # The second write to the key must see the first one.
+        self.assertEqual(redis.zcard("alex"), 1)
+
     def test_event_stream_single(self):
         event = Follow({
             "following": "alex",
@@ -172,6 +344,92 @@ class EventTests(EventTestCase):
             ]),
         ])
 
+    def test_event_stream_dedup(self):
+        d = datetime(2010, 10, 8, 12, 30, 12)
+        c = {
+            "following": "alex",
+            "follower": "jacob",
+        }
+        Follow(c, d).save()
+
+        for objs, clustered_on in [
+            ([User("alex"), User("jacob")], "alex"),
+            ([User("jacob"), User("alex")], "jacob"),
+        ]:
+            self.assert_stream_equal(Stream(*objs, dedup="item"), [
+                StreamCluster("follow", d, [
+                    Follow(c, d),
+                ], clustered_on=clustered_on),
+            ])
+        # The follower and following streams have their own clusters.
+        self.assertEqual(
+            len(list(Stream(User("alex"), User("jacob"), dedup="cluster"))), 2
+        )
+        self.assertEqual(
+            len(list(Stream(User("alex"), User("alex"), dedup="cluster"))), 1
+        )
+
+    def test_event_stream_dedup_prefer_newest(self):
+        d1 = datetime(2010, 10, 8, 12, 30)
+        d2 = datetime(2010, 10, 8, 12, 32)
+        c1 = {"following": "alex", "follower": "jacob"}
+        c2 = {"following": "daniel", "follower": "jacob"}
+        Follow(c1, d1).save()
+        Follow(c2, d2).save()
+
+        # c2 is in jacob's cluster from d1, and in daniel's from d2.
+        self.assert_stream_equal(
+            Stream(User("jacob"), User("daniel"), dedup="item", prefer="newest"), [
+            StreamCluster("follow", d2, [
+                Follow(c2, d2),
+            ], clustered_on="daniel"),
+            StreamCluster("follow", d1, [
+                Follow(c1, d1),
+            ], clustered_on="jacob"),
+        ])
+        self.assert_stream_equal(
+            Stream(User("jacob"), User("daniel"), dedup="item"), [
+            StreamCluster("follow", d1, [
+                Follow(c1, d1),
+                Follow(c2, d2),
+            ], clustered_on="jacob"),
+        ])
+
+    def test_event_stream_dedup_prefer_first_window(self):
+        d1 = datetime(2010, 10, 8, 12, 30)
+        d2 = datetime(2010, 10, 8, 12, 32)
+        ds = [datetime(2010, 10, 8, 12, 31), datetime(2010, 10, 8, 12, 31, 30)]
+        c1 = {"following": "alex", "follower": "jacob"}
+        c2 = {"following": "daniel", "follower": "jacob"}
+        Follow(c1, d1).save()
+        Follow(c2, d2).save()
+        for d in ds:
+            Comment({"commenter": "jacob"}, d).save()
+
+        # The first page ends above jacob's cluster from d1, which still wins
+        # c2 over daniel's cluster from d2.
+        self.assert_stream_equal(
+            Stream(User("jacob"), User("daniel"), dedup="item", limit=1), [
+            StreamCluster("comment", d, [Comment({"commenter": "jacob"}, d)])
+            for d in reversed(ds)
+        ])
+
+    def test_event_stream_dedup_fills_page(self):
+        ds = [
+            datetime(2010, 10, 8, 12) + timedelta(hours=1) * i for i in xrange(6)
+        ]
+        for d in ds:
+            Follow({"following": "alex", "follower": "jacob"}, d).save()
+
+        stream = Stream(User("alex"), User("jacob"), dedup="item", limit=3)
+        self.assert_stream_equal(stream, [
+            StreamCluster("follow", d, [
+                Follow({"following": "alex", "follower": "jacob"}, d),
+            ])
+            for d in reversed(ds[-4:])
+        ])
+        self.assertEqual(len(list(Stream(User("alex"), User("jacob"), limit=3))), 4)
+
     def test_cluster(self):
         Follow({
             "following": "alex",
@@ -276,6 +534,23 @@ class EventTests(EventTestCase):
     # 
     #     self.assert_stream_equal(Stream(User("alex")), [])
 
+    def test_remove_without_status_key(self):
+        # Records written before the status key was stored with them.
+        c = {
+            "following": "alex",
+            "follower": "daniel",
+        }
+        Follow(c, datetime(2010, 10, 8, 9, 32)).save()
+        redis = get_redis_connection()
+        [(member, score)] = redis.zrange("alex", 0, -1, withscores=True)
+        data = json.loads(member)
+        del data["items"][0]["status_key"]
+        redis.zrem("alex", member)
+        redis.zadd("alex", json.dumps(data), score)
+        Follow(c, datetime(2010, 10, 8, 9, 40), remove=True).save()
+
+        self.assert_stream_equal(Stream(User("alex")), [])
+
     def test_remove_cluster(self):
         d1 = datetime(2010, 10, 8, 9, 30)
         d2 = datetime(2010, 10, 8, 9, 32)
@@ -299,6 +574,55 @@ class EventTests(EventTestCase):
             ]),
         ])
 
+    def test_cluster_window(self):
+        d1 = datetime(2010, 10, 8, 12, 30)
+        d2 = datetime(2010, 10, 8, 12, 30, 59)
+        d3 = datetime(2010, 10, 8, 12, 32)
+        c1 = {"voter": "jacob", "candidate": "alex"}
+        c2 = {"voter": "daniel", "candidate": "alex"}
+        c3 = {"voter": "aaron", "candidate": "alex"}
+        Vote(c1, d1).save()
+        Vote(c2, d2).save()
+        Vote(c3, d3).save()
+
+        self.assert_stream_equal(Stream(User("alex")), [
+            StreamCluster("vote", d3, [Vote(c3, d3)]),
+            StreamCluster("vote", d1, [Vote(c1, d1), Vote(c2, d2)]),
+        ])
+
+    def test_max_cluster_items(self):
+        voters = ["jacob", "daniel", "aaron", "ryan", "michael"]
+        ds = [
+            datetime(2010, 10, 8, 12, 30) + timedelta(seconds=10) * i
+            for i in xrange(len(voters))
+        ]
+        for voter, d in zip(voters, ds):
+            Vote({"voter": voter, "candidate": "alex"}, d).save()
+
+        votes = [
+            Vote({"voter": voter, "candidate": "alex"}, d)
+            for voter, d in zip(voters, ds)
+        ]
+        expected = [
+            StreamCluster("vote", ds[4], votes[4:]),
+            StreamCluster("vote", ds[2], votes[2:4]),
+            StreamCluster("vote", ds[0], votes[:2]),
+        ]
+        self.assert_stream_equal(Stream(User("alex")), expected)
+        self.assert_stream_equal(Stream(), expected)
+
+        clusters = StreamClusterModel.objects.filter(clustered_on="candidate")
+        self.assertEqual(
+            sorted(c.items.count() for c in clusters), [1, 2, 2]
+        )
+        for cluster in Stream(User("alex")):
+            self.assertEqual(
+                sorted(e.item_id for e in cluster),
+                sorted(StreamClusterModel.objects.get(
+                    pk=cluster.cluster_id
+                ).items.values_list("pk", flat=True))
+            )
+
     def test_cluster_types(self):
         d1 = datetime(2010, 10, 8, 9, 32)
         d2 = datetime(2010, 10, 8, 9, 33)
@@ -397,6 +721,52 @@ class EventTests(EventTestCase):
         with self.assertNumQueries(1):
             list(Stream(u1, u2))
 
+    def test_context_loading_plan(self):
+        d1 = datetime(2010, 10, 8, 9, 32)
+        d2 = datetime(2010, 10, 8, 9, 33)
+        u1 = UserModel.objects.create_user("joe", "joe@schmoe.net", "abc123")
+        u2 = UserModel.objects.create_user("bob", "bob@schmoe.net", "123abc")
+        LightEvent({"user": u1}, d1).save()
+        LightEvent({"user": u2}, d2).save()
+
+        with self.assertNumQueries(1):
+            clusters = list(Stream(u1, u2))
+        user = clusters[0].events[0].user
+        self.assertEqual(user.pk, u2.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(user.username, "bob")
+        with self.assertNumQueries(1):
+            self.assertEqual(user.email, "bob@schmoe.net")
+
+    def test_context_loading_plans_dont_share_queries(self):
+        d1 = datetime(2010, 10, 8, 9, 32)
+        d2 = datetime(2010, 10, 8, 9, 33)
+        u1 = UserModel.objects.create_user("joe", "joe@schmoe.net", "abc123")
+        u2 = UserModel.objects.create_user("bob", "bob@schmoe.net", "123abc")
+        SomeEvent({"user": u1}, d1).save()
+        LightEvent({"user": u2}, d2).save()
+
+        # One query per distinct loading plan.
+        with self.assertNumQueries(2):
+            list(Stream(u1, u2))
+
+    def test_fetch_many(self):
+        d1 = datetime(2010, 10, 8, 9, 32)
+        d2 = datetime(2010, 10, 8, 9, 33)
+        u1 = UserModel.objects.create_user("joe", "joe@schmoe.net", "abc123")
+        u2 = UserModel.objects.create_user("bob", "bob@schmoe.net", "123abc")
+        SomeEvent({"user": u1}, d1).save()
+        AnotherEvent({"user": u2}, d2).save()
+        Follow({"follower": "alex", "following": "jacob"}, d1).save()
+
+        streams = [Stream(u1), Stream(u2), Stream(u1, u2), Stream()]
+        # 1 query to get all of the users, for all of the streams.
+        with self.assertNumQueries(1):
+            results = Stream.fetch_many(streams)
+        self.assertEqual(len(results), len(streams))
+        for stream, clusters in zip(streams, results):
+            self.assert_stream_equal(clusters, list(stream))
+
     def test_multiple_create_remove(self):
         c = {
             "follower": "alex",
@@ -472,15 +842,405 @@ class EventTests(EventTestCase):
         Follow(c2, d2).save()
 
         redis = get_redis_connection()
-        # 1 - ALL_EVENTS
+        # 1 or 2 - the ALL_EVENTS shards for alex and aaron
         # 8 - each username + each username:follow
-        # 9
-        self.assertEqual(len(redis.keys()), 9)
+        n = len(set([all_events_key("alex"), all_events_key("aaron")])) + 8
+        self.assertEqual(len(redis.keys()), n)
 
         list(Stream(User("alex"), User("aaron")))
-        self.assertEqual(len(redis.keys()), 10)
+        self.assertEqual(len(redis.keys()), n + 1)
         list(Stream(User("alex"), User("aaron")))
-        self.assertEqual(len(redis.keys()), 10)
+        self.assertEqual(len(redis.keys()), n + 1)
+
+    def test_all_stream_sharded(self):
+        followers = ["user%d" % i for i in xrange(10)]
+        ds = [
+            datetime(2010, 10, 8, 12) + timedelta(hours=1) * i
+            for i in xrange(len(followers))
+        ]
+        for follower, d in zip(followers, ds):
+            Follow({"follower": follower, "following": "alex"}, d).save()
+
+        redis = get_redis_connection()
+        shards = [k for k in redis.keys() if k.startswith("ALL_EVENTS")]
+        self.assertTrue(len(shards) > 1)
+        self.assertTrue(set(shards) <= set(all_events_keys()))
+
+        self.assert_stream_equal(Stream(limit=3), [
+            StreamCluster("follow", d, [
+                Follow({"follower": follower, "following": "alex"}, d),
+            ], clustered_on=follower)
+            for follower, d in reversed(zip(followers, ds)[-4:])
+        ])
+
+    def test_all_stream_legacy_key(self):
+        d = datetime(2010, 10, 8, 12)
+        Follow({"follower": "alex", "following": "aaron"}, d).save()
+        expected = [
+            StreamCluster("follow", d, [
+                Follow({"follower": "alex", "following": "aaron"}, d),
+            ], clustered_on="alex"),
+        ]
+
+        # Move it where versions before sharding kept the global stream.
+        redis = get_redis_connection()
+        shard = all_events_key("alex")
+        for item, score in redis.zrange(shard, 0, -1, withscores=True):
+            redis.zadd(ALL_EVENTS, item, score)
+        redis.delete(shard)
+        self.assert_stream_equal(Stream(), expected)
+
+        call_command("timeline_reshard", verbosity=0)
+        self.assertFalse(redis.exists(ALL_EVENTS))
+        self.assertEqual(redis.zcard(shard), 1)
+        self.assert_stream_equal(Stream(), expected)
+
+    def test_sweep_max_count(self):
+        ds = [datetime(2010, 10, 8, 12) + timedelta(hours=1) * i for i in xrange(3)]
+        for d in ds:
+            Comment({"commenter": "alex"}, d).save()
+        Follow({"follower": "alex", "following": "jacob"}, ds[0]).save()
+        # Sorted sets which aren't streams are left alone.
+        get_redis_connection().zadd("leaderboard", "bob", 10)
+
+        self.assertEqual(sweep(), (2, 0))
+        self.assert_stream_equal(Stream(User("alex"), event_type=Comment), [
+            StreamCluster("comment", d, [Comment({"commenter": "alex"}, d)])
+            for d in reversed(ds[1:])
+        ])
+        self.assertEqual(len(list(Stream(User("alex")))), 3)
+        # The global stream isn't trimmed, so the rows stay.
+        self.assertEqual(len(list(Stream())), 4)
+        self.assertEqual(StreamItem.objects.count(), 4)
+        self.assertEqual(StreamClusterModel.objects.count(), 5)
+        self.assertEqual(get_redis_connection().zscore("leaderboard", "bob"), 10)
+
+    def test_sweep_all_events_max_length(self):
+        ds = [datetime(2010, 10, 8, 12) + timedelta(hours=1) * i for i in xrange(3)]
+        settings.TIMELINE_ALL_EVENTS_MAX_LENGTH = 1
+        try:
+            for d in ds:
+                Comment({"commenter": "alex"}, d).save()
+        finally:
+            del settings.TIMELINE_ALL_EVENTS_MAX_LENGTH
+
+        # Only the oldest comment is in no stream anymore.
+        self.assertEqual(sweep(), (2, 1))
+        self.assertEqual(StreamItem.objects.count(), 2)
+        self.assertEqual(StreamClusterModel.objects.count(), 2)
+        self.assertEqual(len(list(Stream(User("alex")))), 2)
+        self.assertEqual(len(list(Stream())), 1)
+        self.assertEqual(sweep(), (0, 0))
+
+    def test_sweep_max_count_clustered(self):
+        d = datetime(2010, 10, 8, 12)
+        follows = [
+            Follow({"follower": "alex", "following": "user%d" % i},
+                d + timedelta(minutes=1) * i)
+            for i in xrange(5)
+        ]
+        for follow in follows:
+            follow.save()
+
+        Follow.max_count = 2
+        try:
+            self.assertEqual(sweep(), (2, 0))
+        finally:
+            del Follow.max_count
+        self.assert_stream_equal(Stream(User("alex")), [
+            StreamCluster("follow", d, follows[-2:], clustered_on="alex"),
+        ])
+        self.assertEqual(len(iter(Stream()).next()), 5)
+
+    def test_sweep_max_age(self):
+        now = datetime.now().replace(microsecond=0)
+        old = now - timedelta(days=60)
+        Like({"liker": "alex"}, old).save()
+        Like({"liker": "alex"}, now).save()
+        Follow({"follower": "alex", "following": "jacob"}, old).save()
+
+        self.assertEqual(sweep(batch_size=1), (3, 1))
+        self.assert_stream_equal(Stream(User("alex")), [
+            StreamCluster("like", now, [Like({"liker": "alex"}, now)]),
+            StreamCluster("follow", old, [
+                Follow({"follower": "alex", "following": "jacob"}, old),
+            ]),
+        ])
+        self.assertEqual(StreamItem.objects.count(), 2)
+        self.assertEqual(StreamClusterModel.objects.count(), 3)
+        self.assertEqual(sweep(), (0, 0))
+
+    def test_since(self):
+        d1 = datetime(2010, 10, 8, 12, 30)
+        d2 = datetime(2010, 10, 8, 12, 33)
+        d3 = datetime(2010, 10, 8, 12, 40)
+        c1 = {"follower": "alex", "following": "daniel"}
+        c2 = {"follower": "alex", "following": "aaron"}
+        c3 = {"follower": "aaron", "following": "alex"}
+        Follow(c1, d1).save()
+        Follow(c2, d2).save()
+        Follow(c3, d3).save()
+
+        since = time.mktime(d1.timetuple())
+        self.assert_stream_equal(Stream(User("alex"), since=since), [
+            StreamCluster("follow", d3, [Follow(c3, d3)]),
+            StreamCluster("follow", d1, [Follow(c1, d1), Follow(c2, d2)]),
+        ])
+        since = time.mktime(d2.timetuple())
+        self.assert_stream_equal(Stream(since=since), [
+            StreamCluster("follow", d3, [Follow(c3, d3)]),
+        ])
+
+    def test_listener(self):
+        settings.TIMELINE_PUBLISH = True
+        listener = StreamListener(Stream(User("alex")))
+        everything = StreamListener(Stream())
+        try:
+            self.assertEqual(listener.wait(timeout=0.1), [])
+
+            d1 = datetime(2010, 10, 8, 12, 30)
+            d2 = datetime(2010, 10, 8, 12, 33)
+            c1 = {"follower": "alex", "following": "daniel"}
+            c2 = {"follower": "alex", "following": "aaron"}
+            Follow(c1, d1).save()
+            Follow({"follower": "jacob", "following": "aaron"}, d2).save()
+            self.assert_stream_equal(listener.changes(timeout=1), [
+                StreamCluster("follow", d1, [Follow(c1, d1)]),
+            ])
+            self.assertEqual(len(everything.changes(timeout=1)), 2)
+
+            Follow(c2, d2).save()
+            [notification] = listener.wait(timeout=1)
+            self.assertEqual(notification["key"], "alex")
+            self.assertEqual(notification["score"], time.mktime(d1.timetuple()))
+            self.assertEqual(notification["slug"], "follow")
+        finally:
+            del settings.TIMELINE_PUBLISH
+            listener.close()
+            everything.close()
+
+    def test_page_cache(self):
+        d1 = datetime(2010, 10, 8, 12, 30)
+        d2 = datetime(2010, 10, 8, 12, 40)
+        c1 = {"follower": "alex", "following": "daniel"}
+        c2 = {"follower": "alex", "following": "aaron"}
+        settings.TIMELINE_PAGE_CACHE = True
+        try:
+            Follow(c1, d1).save()
+            for stream in [Stream(User("alex")), Stream()]:
+                self.assertEqual(len(list(stream)), 1)
+
+            # Changed behind timeline's back, so the cached pages are used.
+            redis = get_redis_connection()
+            redis.delete("alex", all_events_key("alex"))
+            for stream in [Stream(User("alex")), Stream()]:
+                self.assertEqual(len(list(stream)), 1)
+            self.assertEqual(list(Stream(User("alex"), cache=False)), [])
+            get_page_cache().pages.clear()
+            self.assertEqual(len(list(Stream(User("alex")))), 1)
+
+            Follow(c2, d2).save()
+            for stream in [Stream(User("alex")), Stream()]:
+                self.assert_stream_equal(stream, [
+                    StreamCluster("follow", d2, [Follow(c2, d2)]),
+                ])
+        finally:
+            del settings.TIMELINE_PAGE_CACHE
+            get_page_cache().pages.clear()
+            cache.clear()
+
+    def test_page_cache_lru(self):
+        page_cache = PageCache(2, 60)
+        page_cache.set_many({"a": 1, "b": 2})
+        page_cache.get_many(["a"])
+        page_cache.set_many({"c": 3})
+        self.assertEqual(page_cache.pages.keys(), ["a", "c"])
+        # Still in the shared cache.
+        self.assertEqual(page_cache.get_many(["b"]), {"b": 2})
+        self.assertEqual(page_cache.pages.keys(), ["c", "b"])
+        cache.clear()
+        # Expired pages aren't returned from this process either.
+        page_cache.pages["c"] = (time.time() - 1, 3)
+        self.assertEqual(page_cache.get_many(["c"]), {})
+        self.assertEqual(page_cache.pages.keys(), ["b"])
+
+    def test_page_cache_setting_required(self):
+        # Writes don't invalidate pages without the setting.
+        self.assertFalse(Stream(User("alex"), cache=True).cache)
+
+    def test_stats(self):
+        d = datetime(2010, 10, 8, 12, 30)
+        for follower in ["alex", "jacob", "daniel"]:
+            Follow({"follower": follower, "following": "aaron"}, d).save()
+        Poke({"poker": "alex", "pokee": "aaron"}, d + timedelta(days=2)).save()
+        list(Stream(User("alex"), User("jacob")))
+        get_redis_connection().zadd("leaderboard", "bob", 10)
+
+        out = StringIO()
+        call_command("timeline_stats", json=True, stdout=out)
+        stats = json.loads(out.getvalue())
+        self.assertEqual(stats["union_keys"], 1)
+        self.assertEqual(stats["other_zsets"], 1)
+        # alex, jacob, daniel and aaron, each with a per-type key, plus
+        # alex:poke and aaron:poke, plus the ALL_EVENTS shards.
+        shards = len(set(all_events_key(user) for user in ["alex", "jacob", "daniel"]))
+        self.assertEqual(stats["streams"], 10 + shards)
+        self.assertEqual(set(stats["slugs"]), set(["follow", "poke"]))
+        # alex, alex:poke, aaron, aaron:poke and a shard.
+        self.assertEqual(stats["slugs"]["poke"]["sampled_clusters"], 5)
+        self.assertTrue(stats["memory"] > 0)
+        self.assertTrue(stats["growth_per_day"] > 0)
+
+        out = StringIO()
+        call_command("timeline_stats", stdout=out)
+        self.assertTrue("Largest streams:" in out.getvalue())
+        self.assertTrue("1 zset" in out.getvalue())
+
+    def test_budget(self):
+        d = datetime(2010, 10, 8, 12, 30)
+        Follow({"follower": "alex", "following": "jacob"}, d).save()
+        s = Stream(User("alex"), budget_ms=1000)
+        self.assertEqual(len(list(s)), 1)
+        self.assertEqual(s.degradations, [])
+
+    def test_budget_union_skipped(self):
+        users = ["alex", "jacob", "daniel", "aaron"]
+        ds = [datetime(2010, 10, 8, 12) + timedelta(hours=1) * i for i in xrange(4)]
+        for user, d in zip(users, ds):
+            Follow({"follower": user, "following": "charlie"}, d).save()
+        redis = get_redis_connection()
+        n = len(redis.keys())
+
+        settings.TIMELINE_MAX_UNION_KEYS = 3
+        try:
+            s = Stream(*[User(u) for u in users], **{"budget_ms": 1000, "limit": 1})
+            self.assert_stream_equal(s, [
+                StreamCluster("follow", d, [
+                    Follow({"follower": user, "following": "charlie"}, d),
+                ])
+                for user, d in reversed(zip(users, ds)[-2:])
+            ])
+            self.assertEqual(s.degradations, ["union_skipped"])
+            self.assertEqual(len(redis.keys()), n)
+        finally:
+            del settings.TIMELINE_MAX_UNION_KEYS
+
+    def test_budget_redis_unavailable(self):
+        Follow({"follower": "alex", "following": "jacob"}).save()
+        redis_settings = settings.REDIS_SETTINGS
+        settings.REDIS_SETTINGS = {"port": 1}
+        try:
+            s = Stream(User("alex"), budget_ms=100)
+            self.assertEqual(list(s), [])
+            self.assertEqual(s.degradations, ["redis_unavailable"])
+        finally:
+            settings.REDIS_SETTINGS = redis_settings
+
+    def test_deserialize_deadline(self):
+        u = UserModel.objects.create_user("joe", "joe@schmoe.net", "abc123")
+        field = SomeEvent.schema.fields["user"]
+        context_items = {
+            field.unique_key: RawResults(field.spec, set([u.pk])),
+        }
+        with self.assertNumQueries(1):
+            loaded = deserialize_context_items(context_items, time.time() + 60)
+        self.assertEqual(loaded[field.unique_key][u.pk], u)
+        with self.assertNumQueries(0):
+            loaded = deserialize_context_items(context_items, time.time())
+        placeholder = loaded[field.unique_key][u.pk]
+        self.assertTrue(isinstance(placeholder, Placeholder))
+        self.assertFalse(placeholder)
+        self.assertEqual(placeholder.value, u.pk)
+
+    def test_backfill(self):
+        d1 = datetime(2010, 10, 8, 12, 30)
+        d2 = datetime(2010, 10, 8, 12, 31)
+        d3 = datetime(2010, 10, 8, 14, 30)
+        c1 = {"tagger": "alex", "tagged": "jacob"}
+        c2 = {"tagger": "daniel", "tagged": "jacob"}
+        c3 = {"tagger": "alex", "tagged": "jacob"}
+        Tag(c1, d1).save()
+        Tag(c2, d2).save()
+        Tag(c3, d3).save()
+        Follow({"follower": "alex", "following": "jacob"}, d1).save()
+        self.assertEqual(len(list(Stream(User("jacob"), event_type=Tag))), 0)
+
+        Tag.queryable_by = ["tagger", "tagged"]
+        try:
+            self.assertEqual(backfill(Tag, ["tagged"], chunk_size=1), 3)
+            expected = [
+                StreamCluster("tag", d3, [Tag(c3, d3)]),
+                StreamCluster("tag", d1, [Tag(c1, d1), Tag(c2, d2)]),
+            ]
+            self.assert_stream_equal(Stream(User("jacob"), event_type=Tag), expected)
+            self.assertEqual(len(list(Stream(User("jacob")))), 3)
+            self.assert_stream_equal(Stream(User("alex"), event_type=Tag), [
+                StreamCluster("tag", d3, [Tag(c3, d3)]),
+                StreamCluster("tag", d1, [Tag(c1, d1)]),
+            ])
+
+            # A finished run leaves no checkpoint, and running it again
+            # doesn't add anything twice.
+            redis = get_redis_connection()
+            self.assertFalse(redis.exists(get_backfill_key(Tag, ["tagged"])))
+            Tag(c1, d3 + timedelta(hours=1)).save()
+            self.assertEqual(backfill(Tag, ["tagged"]), 0)
+            self.assertEqual(len(list(Stream(User("jacob"), event_type=Tag))), 3)
+        finally:
+            Tag.queryable_by = ["tagger"]
+
+    def test_backfill_microseconds(self):
+        d = datetime(2010, 10, 8, 12, 0, 0, 123456)
+        c = {"follower": "alex", "following": "jacob"}
+        Follow(c, d).save()
+
+        self.assertEqual(backfill(Follow, ["follower", "following"]), 0)
+        self.assertEqual([len(c) for c in Stream(User("jacob"))], [1])
+
+    def test_backfill_resume_after_trim(self):
+        ds = [datetime(2010, 10, 8, 12) + timedelta(hours=1) * i for i in xrange(3)]
+        for i, d in enumerate(ds):
+            Tag({"tagger": "alex", "tagged": "user%d" % i}, d).save()
+
+        def interrupt(seconds):
+            raise KeyboardInterrupt
+        sleep = time.sleep
+        Tag.queryable_by = ["tagger", "tagged"]
+        try:
+            # Stopped after the first chunk.
+            time.sleep = interrupt
+            try:
+                self.assertRaises(KeyboardInterrupt, backfill, Tag, ["tagged"],
+                    chunk_size=1)
+            finally:
+                time.sleep = sleep
+            # The oldest cluster is trimmed before the next run.
+            get_redis_connection().zremrangebyrank(all_events_key("alex"), 0, 0)
+            self.assertEqual(backfill(Tag, ["tagged"]), 2)
+        finally:
+            Tag.queryable_by = ["tagger"]
+        for i in xrange(3):
+            self.assertEqual(len(list(Stream(User("user%d" % i)))), 1)
+
+    def test_backfill_again(self):
+        Tag({"tagger": "alex", "tagged": "jacob"}, datetime(2010, 10, 8)).save()
+        self.assertEqual(backfill(Tag, ["tagger"]), 0)
+
+        Tag.queryable_by = ["tagger", "tagged"]
+        try:
+            self.assertEqual(backfill(Tag, ["tagged"]), 1)
+        finally:
+            Tag.queryable_by = ["tagger"]
+        self.assertEqual(len(list(Stream(User("jacob")))), 1)
+
+    def test_backfill_max_count(self):
+        ds = [datetime(2010, 10, 8, 12) + timedelta(hours=1) * i for i in xrange(4)]
+        for d in ds:
+            Comment({"commenter": "bob"}, d).save()
+        sweep()
+
+        self.assertEqual(backfill(Comment, ["commenter"]), 0)
+        self.assertEqual(len(list(Stream(User("bob")))), 2)
 
     def test_offset(self):
         d1 = datetime(2010, 10, 8, 12, 30)